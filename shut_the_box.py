@@ -26,7 +26,42 @@ TODO: Show stats of each strategy
     - Number of exact wins (score = 0)
     - Average number of turns
 """
-from random import choice, randint
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from random import choice, choices, randrange
+
+# The tiles still up are stored as a 9-bit mask, where bit i - 1 is set if tile i is up
+ALL_TILES = tuple(range(1, 10))
+FULL_MASK = 0x1FF
+ALL_MASKS = range(FULL_MASK + 1)
+
+SCORE = tuple(sum(i for i in ALL_TILES if mask >> (i - 1) & 1) for mask in ALL_MASKS)
+POPCOUNT = tuple(bin(mask).count("1") for mask in ALL_MASKS)
+# The bit for the tile matching a roll, or 0 for rolls that no single tile can match
+EXACT_BIT = tuple(1 << (roll - 1) if 1 <= roll <= 9 else 0 for roll in range(13))
+
+# A roll of both dice is one of 36 equally likely outcomes, (first - 1) * 6 + (second - 1),
+# so a single draw gives both the total and, when only 1 die is rolled, the first die
+DICE_OUTCOMES = range(36)
+TWO_DICE_TOTAL = tuple(first + second for first in range(1, 7) for second in range(1, 7))
+FIRST_DIE = tuple(first for first in range(1, 7) for _ in range(6))
+# Every turn but the last removes at least one tile, so a game never rolls more than 10 times
+MAX_ROLLS = 10
+
+LOWEST_FIRST = ALL_TILES
+HIGHEST_FIRST = ALL_TILES[::-1]
+
+
+def mask_to_numbers(mask):
+    return [i for i in ALL_TILES if mask >> (i - 1) & 1]
+
+
+# Every subset of the tiles, grouped by its sum. Each group is ordered as the sorted
+# tile lists would be (e.g. [1, 2, 6] before [1, 3, 5]), so ties are broken consistently.
+SUBSETS_BY_SUM = tuple([] for _ in range(SCORE[FULL_MASK] + 1))
+for _mask in sorted(ALL_MASKS[1:], key=mask_to_numbers):
+    SUBSETS_BY_SUM[SCORE[_mask]].append(_mask)
 
 
 class Game:
@@ -34,34 +69,34 @@ class Game:
     Represents a single game of shut the box
     """
 
+    __slots__ = ("mask", "strategy")
+
     def __init__(self, strategy):
-        self.numbers = [num for num in range(1, 10)]
+        self.mask = FULL_MASK
         self.strategy = strategy
 
     def play(self):
+        strategy = self.strategy
         roll = self.roll()
-        self.strategy.choose_numbers(self.numbers, roll)
-        while self.numbers and self.strategy.answer:
+        strategy.choose_numbers(self.mask, roll)
+        while self.mask and strategy.answer:
             # Remove numbers as determined by strategy
-            for number in self.strategy.answer:
-                self.numbers.remove(number)
-
-            # Reset strategy
-            self.strategy.answer = []
+            self.mask ^= strategy.answer
 
             # Roll again
             roll = self.roll()
 
             # Choose number(s) to remove
-            self.strategy.choose_numbers(self.numbers, roll)
+            strategy.choose_numbers(self.mask, roll)
 
     def roll(self):
-        if self.numbers == [1]:  # If only remaining number is 1, roll 1 die
-            return randint(1, 6)
-        return randint(1, 6) + randint(1, 6)
+        outcome = randrange(36)
+        if self.mask == 1:  # If only remaining number is 1, roll 1 die
+            return FIRST_DIE[outcome]
+        return TWO_DICE_TOTAL[outcome]
 
     def score(self):
-        return sum(self.numbers)
+        return SCORE[self.mask]
 
 
 class DualStrategyGame(Game):
@@ -72,6 +107,8 @@ class DualStrategyGame(Game):
     a specific number.
     """
 
+    __slots__ = ("strategy_2", "threshold")
+
     def __init__(self, strategy, strategy_2, threshold):
         super().__init__(strategy)
         self.strategy_2 = strategy_2
@@ -80,14 +117,10 @@ class DualStrategyGame(Game):
     def play(self):
         roll = self.roll()
         strategy = self.strategy
-        strategy.choose_numbers(self.numbers, roll)
-        while self.numbers and strategy.answer:
+        strategy.choose_numbers(self.mask, roll)
+        while self.mask and strategy.answer:
             # Remove numbers as determined by strategy
-            for number in strategy.answer:
-                self.numbers.remove(number)
-
-            # Reset strategy
-            strategy.answer = []
+            self.mask ^= strategy.answer
 
             # Change strategy if score < threshold
             if self.score() < self.threshold:
@@ -97,77 +130,232 @@ class DualStrategyGame(Game):
             roll = self.roll()
 
             # Choose number(s) to remove
-            strategy.choose_numbers(self.numbers, roll)
+            strategy.choose_numbers(self.mask, roll)
 
 
-class Strategy:
+def play_game(strategy, dice):
     """
-    Represents the number-removing strategy for a game of STB
+    Plays a single game with strategy, drawing rolls from dice, and returns its score
+
+    Unlike Game, this keeps the tiles in a local variable, so nothing is allocated per game.
     """
+    mask = FULL_MASK
+    while mask:
+        outcome = next(dice)
+        # If only remaining number is 1, roll 1 die
+        roll = FIRST_DIE[outcome] if mask == 1 else TWO_DICE_TOTAL[outcome]
 
-    def __init__(self):
-        self.answer = []
+        strategy.choose_numbers(mask, roll)
+        answer = strategy.answer
+        if not answer:
+            break
 
-    def choose_numbers(self, numbers, roll):
-        raise NotImplementedError
+        mask ^= answer
+
+    return SCORE[mask]
 
 
-class LowestFirst(Strategy):
+def play_policy_games(policy, games, dice):
     """
-    A strategy wherein we remove the lowest possible numbers first
+    Plays games with a strategy's policy table, drawing rolls from dice, and returns their scores
+
+    This is play_game() with the strategy's lookup done inline, so every turn is plain
+    integer work with no method calls.
     """
+    scores = []
+    for _ in range(games):
+        mask = FULL_MASK
+        while mask:
+            outcome = next(dice)
+            # If only remaining number is 1, roll 1 die
+            roll = FIRST_DIE[outcome] if mask == 1 else TWO_DICE_TOTAL[outcome]
 
-    def __init__(self):
-        super().__init__()
+            answer = policy[mask * 13 + roll]
+            if not answer:
+                break
+
+            mask ^= answer
 
-    def choose_numbers(self, numbers, roll):
-        if roll == 0:
-            return True
+        scores.append(SCORE[mask])
 
-        for number in numbers:
-            if number > roll:
-                return False
+    return scores
 
-            self.answer.append(number)
 
-            new_nums = numbers[:]
-            new_nums.remove(number)
-            if LowestFirst.choose_numbers(self, new_nums, roll - number):
-                return True
+def play_games(strategy, games):
+    """
+    Plays the given number of games with strategy and returns a list of their scores
 
-            self.answer.remove(number)
+    This gives the same results as calling Game(strategy).play() repeatedly, but all of
+    the dice are drawn up front in a single call rather than 1 call per turn.
+    """
+    dice = iter(choices(DICE_OUTCOMES, k=games * MAX_ROLLS))
+    strategy.prepare()
+    if strategy.policy is not None:
+        return play_policy_games(strategy.policy, games, dice)
+    return [play_game(strategy, dice) for _ in range(games)]
 
-        return False
 
+def play_games_parallel(strategy, games, workers=None):
+    """
+    Plays the given number of games with strategy across worker processes and returns their scores
 
-class HighestFirst(Strategy):
+    The strategy is pickled to each worker, so it can't use a lambda as a secondary_strategy.
+    Its policy is built here first so that it is sent along with it instead of rebuilt by
+    every worker.
     """
-    A strategy wherein we remove the highest possible numbers first
+    workers = workers or os.cpu_count() or 1
+    strategy.prepare()
+
+    batch_sizes = [games // workers + (i < games % workers) for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        batches = executor.map(play_games, [strategy] * workers, batch_sizes)
+        return [score for batch in batches for score in batch]
+
+
+class Strategy:
+    """
+    Represents the number-removing strategy for a game of STB
+
+    choose_numbers() is given the mask of tiles still up and sets self.answer to
+    the mask of tiles to remove, or to 0 if there is no solution. The answer is
+    overwritten every turn, so games never need to reset it.
+
+    Deterministic strategies only need to implement find_answer(); prepare() (called
+    by the first choose_numbers(), if not before) runs it once for every (mask, roll)
+    pair and caches the results in self.policy, so that every later turn is a single lookup.
+    Policies are also kept in POLICIES by policy_key(), so strategies that would make the
+    same choices (e.g. every FewestNumbers(lowest_number)) build one between them.
     """
 
+    __slots__ = ("answer", "policy")
+
     def __init__(self):
-        super().__init__()
+        self.answer = 0
+        self.policy = None
 
-    def choose_numbers(self, numbers, roll):
-        if roll == 0:
-            return True
+    def prepare(self):
+        if self.policy is None:
+            key = self.policy_key()
+            if key not in POLICIES:
+                POLICIES[key] = build_policy(self)
+            self.policy = POLICIES[key]
 
-        numbers = sorted(numbers, reverse=True)
+    def policy_key(self):
+        return type(self)
 
-        for number in numbers:
-            if number > roll:
-                continue
+    def choose_numbers(self, mask, roll):
+        if self.policy is None:
+            self.prepare()
+        self.answer = self.policy[mask * 13 + roll]
 
-            self.answer.append(number)
+    def find_answer(self, mask, roll):
+        raise NotImplementedError
 
-            new_nums = numbers[:]
-            new_nums.remove(number)
-            if HighestFirst.choose_numbers(self, new_nums, roll - number):
-                return True
 
-            self.answer.remove(number)
+POLICIES = {}
 
-        return False
+
+def build_policy(strategy):
+    """Return strategy's answer for every (mask, roll), indexed by mask * 13 + roll."""
+    return [
+        strategy.find_answer(mask, roll) if roll else 0 for mask in ALL_MASKS for roll in range(13)
+    ]
+
+
+@lru_cache(maxsize=None)
+def order_tails(order):
+    """Return a tuple whose i-th element is the mask of the tiles in order[i:]."""
+    tails = [0] * (len(order) + 1)
+    for i in range(len(order) - 1, -1, -1):
+        tails[i] = tails[i + 1] | 1 << (order[i] - 1)
+    return tuple(tails)
+
+
+def find_first_solution(mask, roll, order):
+    """
+    Return the first solution found when trying the tiles in mask in the given order
+
+    This is a depth-first search, with an explicit stack rather than recursion. At each
+    depth, every tile still up is tried in order, and on a dead end we go back up a level
+    and try the tile after the one chosen there.
+
+    Once a tile has been tried at some depth, no solution below that depth uses it, so if
+    the tiles still up from order[index] onwards (that aren't above roll) can't add up to
+    roll, it's a dead end and we can backtrack straight away.
+    """
+    tails = order_tails(order)
+    remaining = mask
+    stack = []  # The index into order of the tile chosen at each depth
+    index = 0
+    while True:
+        # Only tiles no higher than roll, from order[index] onwards, could still be used
+        if index == len(order) or SCORE[remaining & tails[index] & ((1 << roll) - 1)] < roll:
+            if not stack:
+                return 0
+
+            # Dead end, so put back the last tile chosen and try the one after it
+            index = stack.pop()
+            remaining |= 1 << (order[index] - 1)
+            roll += order[index]
+            index += 1
+            continue
+
+        number = order[index]
+        bit = 1 << (number - 1)
+        if number > roll or not remaining & bit:
+            index += 1
+            continue
+
+        if number == roll:
+            # The tiles taken from the original mask, plus this one
+            return (mask ^ remaining) | bit
+
+        stack.append(index)
+        remaining ^= bit
+        roll -= number
+        index = 0
+
+
+class GreedyStrategy(Strategy):
+    """
+    A base class for strategies that remove the first solution found by trying the tiles in order
+
+    Subclasses only set the class attributes: order is the order in which the tiles are
+    tried, and if try_exact is set, the tile matching the roll is removed if it's still up.
+    """
+
+    __slots__ = ()
+
+    order = LOWEST_FIRST
+    try_exact = False
+
+    def find_answer(self, mask, roll):
+        if self.try_exact:
+            bit = EXACT_BIT[roll]
+            if mask & bit:
+                return bit
+
+        return find_first_solution(mask, roll, self.order)
+
+
+class LowestFirst(GreedyStrategy):
+    """
+    A strategy wherein we remove the lowest possible numbers first
+    """
+
+    __slots__ = ()
+
+    order = LOWEST_FIRST
+
+
+class HighestFirst(GreedyStrategy):
+    """
+    A strategy wherein we remove the highest possible numbers first
+    """
+
+    __slots__ = ()
+
+    order = HIGHEST_FIRST
 
 
 class ExactThenLowest(LowestFirst):
@@ -175,15 +363,9 @@ class ExactThenLowest(LowestFirst):
     A strategy wherein we remove the exact sum of the dice, if possible, and then lowest first.
     """
 
-    def __init__(self):
-        super().__init__()
-
-    def choose_numbers(self, numbers, roll):
-        if roll in numbers:
-            self.answer.append(roll)
-            return
+    __slots__ = ()
 
-        super().choose_numbers(numbers, roll)
+    try_exact = True
 
 
 class ExactThenHighest(HighestFirst):
@@ -191,15 +373,9 @@ class ExactThenHighest(HighestFirst):
     A strategy wherein we remove the exact sum of the dice, if possible, and then highest first.
     """
 
-    def __init__(self):
-        super().__init__()
-
-    def choose_numbers(self, numbers, roll):
-        if roll in numbers:
-            self.answer.append(roll)
-            return
+    __slots__ = ()
 
-        super().choose_numbers(numbers, roll)
+    try_exact = True
 
 
 class Random(Strategy):
@@ -207,47 +383,53 @@ class Random(Strategy):
     A strategy wherein we calculate all possible solutions and then pick one randomly.
     """
 
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
 
-    def choose_numbers(self, numbers, roll):
+    def prepare(self):
+        # Every turn is decided randomly, so there is no policy to build
+        pass
+
+    def choose_numbers(self, mask, roll):
         # Calculate all possible solutions
-        solutions = find_all_solutions(numbers, roll)
+        solutions = find_all_solutions(mask, roll)
 
         # Pick one randomly
-        if solutions:
-            self.answer = choice(solutions)
+        self.answer = choice(solutions) if solutions else 0
 
 
 # TODO: When reorganizing this module into many, put this into a common file
-def find_all_solutions(numbers, target):
-    solutions = []
+@lru_cache(maxsize=None)
+def find_all_solutions(mask, target):
+    """
+    Return the masks of every subset of the tiles in mask that sum to target
 
-    # DFS approach
-    def recurse(numbers, target, subsolution):
-        if target == 0:
-            solutions.append(subsolution)
+    There are only 512 * 13 possible arguments, so every result is cached. The result
+    is a tuple so that callers can't modify the cached copy.
+    """
+    return tuple(subset for subset in SUBSETS_BY_SUM[target] if not subset & ~mask)
 
-        if target < 0:
-            return
 
-        for index, number in enumerate(numbers):
-            recurse(numbers[index + 1 :], target - number, [*subsolution, number])
+def lowest_number(solution):
+    """Secondary strategy that prefers the solution with the lowest number"""
+    # The lowest set bit of the mask is the lowest number
+    return (solution & -solution).bit_length()
 
-    recurse(numbers, target, [])
 
-    return solutions
+def highest_number(solution):
+    """Secondary strategy that prefers the solution with the highest number"""
+    # The highest set bit of the mask is the highest number
+    return -solution.bit_length()
 
 
 class SolutionLength(Strategy):
     """
     A base class for strategies that aim to use solutions with specific lengths
 
-    Because sorted() yields in increasing order (unless otherwise specified),
+    Because min() picks the solution with the lowest key,
     we need to define our secondary_strategy's in a way that gives the best solution
-    the lowest value.
-      - To get solution with lowest number: min(x)
-      - To get solution with highest number: lambda x: -1 * max(x)
+    the lowest value. It is given the solution's mask.
+      - To get solution with lowest number: lowest_number
+      - To get solution with highest number: highest_number
     In reality, this level of modularity isn't required for just min and max, because
     any solution that contains the minimum number will also contain the maximum number (proof?).
 
@@ -255,13 +437,18 @@ class SolutionLength(Strategy):
     as possible, then this is useful.
     """
 
+    __slots__ = ("secondary_strategy",)
+
     def __init__(self, secondary_strategy):
         super().__init__()
 
         # To break ties, we'll use the secondary_strategy function
         self.secondary_strategy = secondary_strategy
 
-    def choose_numbers(self, numbers, roll):
+    def policy_key(self):
+        return type(self), self.secondary_strategy
+
+    def find_answer(self, mask, roll):
         raise NotImplementedError
 
 
@@ -270,20 +457,19 @@ class FewestNumbers(SolutionLength):
     A strategy wherein we choose the solution with the fewest possible numbers
     """
 
-    def __init__(self, secondary_strategy):
-        super().__init__(secondary_strategy)
+    __slots__ = ()
 
-    def choose_numbers(self, numbers, roll):
-        solutions = find_all_solutions(numbers, roll)
-        if solutions:
-            # Only consider solutions of the shortest length
-            shortest_solution_length = min(len(solution) for solution in solutions)
+    def find_answer(self, mask, roll):
+        solutions = find_all_solutions(mask, roll)
+        if not solutions:
+            return 0
 
-            # Find the solution with the lowest/highest number
-            self.answer = sorted(
-                [solution for solution in solutions if len(solution) == shortest_solution_length],
-                key=lambda sol: self.secondary_strategy(sol),
-            )[0]
+        # Only consider solutions of the shortest length, and among those,
+        # find the solution with the lowest/highest number, all in one pass
+        return min(
+            solutions,
+            key=lambda sol: (POPCOUNT[sol], self.secondary_strategy(sol)),
+        )
 
 
 class MostNumbers(SolutionLength):
@@ -291,20 +477,19 @@ class MostNumbers(SolutionLength):
     A strategy wherein we choose the solution with the most possible numbers
     """
 
-    def __init__(self, secondary_strategy):
-        super().__init__(secondary_strategy)
+    __slots__ = ()
 
-    def choose_numbers(self, numbers, roll):
-        solutions = find_all_solutions(numbers, roll)
-        if solutions:
-            # Only consider solutions of the longest length
-            shortest_solution_length = max(len(solution) for solution in solutions)
+    def find_answer(self, mask, roll):
+        solutions = find_all_solutions(mask, roll)
+        if not solutions:
+            return 0
 
-            # Find the solution with the lowest/highest number
-            self.answer = sorted(
-                [solution for solution in solutions if len(solution) == shortest_solution_length],
-                key=lambda sol: self.secondary_strategy(sol),
-            )[0]
+        # Only consider solutions of the longest length, and among those,
+        # find the solution with the lowest/highest number, all in one pass
+        return min(
+            solutions,
+            key=lambda sol: (-POPCOUNT[sol], self.secondary_strategy(sol)),
+        )
 
 
 if __name__ == "__main__":
@@ -313,26 +498,21 @@ if __name__ == "__main__":
     # strategy = ExactThenLowest()
     # strategy = ExactThenHighest()
     # strategy = Random()
-    # strategy = FewestNumbers(secondary_strategy=min)  # If tied, use solution with lowest number
     # strategy = FewestNumbers(
-    #     secondary_strategy=lambda x: -1 * max(x)
+    #     secondary_strategy=lowest_number
+    # )  # If tied, use solution with lowest number
+    # strategy = FewestNumbers(
+    #     secondary_strategy=highest_number
     # )  # If tied, use solution with highest number
-    # strategy = MostNumbers(secondary_strategy=min)
+    # strategy = MostNumbers(secondary_strategy=lowest_number)
 
     # Head 2 Head
     strategy_1 = ExactThenHighest()
-    strategy_2 = FewestNumbers(secondary_strategy=min)
-    strategy_1_wins = 0
+    strategy_2 = FewestNumbers(secondary_strategy=lowest_number)
     games_to_play = 10_000
-    for i in range(games_to_play):
-        game_1 = Game(strategy_1)
-        game_2 = Game(strategy_2)
-
-        game_1.play()
-        game_2.play()
-
-        if game_1.score() < game_2.score():
-            strategy_1_wins += 1
+    scores_1 = play_games(strategy_1, games_to_play)
+    scores_2 = play_games(strategy_2, games_to_play)
+    strategy_1_wins = sum(score_1 < score_2 for score_1, score_2 in zip(scores_1, scores_2))
 
     print(type(strategy_1).__name__ + f": {strategy_1_wins}")
     print(type(strategy_2).__name__ + f": {games_to_play - strategy_1_wins}")
@@ -344,8 +524,8 @@ if __name__ == "__main__":
     #     ExactThenLowest(),
     #     ExactThenHighest(),
     #     Random(),
-    #     FewestNumbers(secondary_strategy=min),
-    #     MostNumbers(secondary_strategy=min),
+    #     FewestNumbers(secondary_strategy=lowest_number),
+    #     MostNumbers(secondary_strategy=lowest_number),
     # ]
     # THRESHOLD = 10
     # for strategy in STRATEGIES: